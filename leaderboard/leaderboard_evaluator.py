@@ -90,7 +90,8 @@ class LeaderboardEvaluator(object):
         self.module_agent = importlib.import_module(module_name)
 
         # Create the ScenarioManager
-        self.manager = ScenarioManager(args.timeout, args.debug > 1)
+        self.manager = ScenarioManager(args.timeout, args.debug > 1, threaded_agent=args.threaded_agent,
+                                       tick_timeout=args.tick_timeout, agent_timeout=args.agent_timeout)
 
         # Time control for summary purposes
         self._start_time = GameTime.get_time()
@@ -133,6 +134,9 @@ class LeaderboardEvaluator(object):
             self.world.apply_settings(settings)
             self.traffic_manager.set_synchronous_mode(False)
 
+        # An agent stuck in its thread can't be safely destroyed
+        agent_running = self.manager.is_agent_running() if self.manager else False
+
         if self.manager:
             self.manager.cleanup()
 
@@ -148,7 +152,10 @@ class LeaderboardEvaluator(object):
             self._agent_watchdog.stop()
 
         if hasattr(self, 'agent_instance') and self.agent_instance:
-            self.agent_instance.destroy()
+            if agent_running:
+                print("\033[91mThe agent is still running, skipping its destruction\033[0m")
+            else:
+                self.agent_instance.destroy()
             self.agent_instance = None
 
         if hasattr(self, 'statistics_manager') and self.statistics_manager:
@@ -423,6 +430,10 @@ def main():
                         help='Use CARLA recording feature to create a recording of the scenario')
     parser.add_argument('--timeout', default=60.0, type=float,
                         help='Set the CARLA client timeout value in seconds')
+    parser.add_argument('--tick-timeout', default=None, type=float,
+                        help='Time given to the world ticks in seconds (default: the timeout value)')
+    parser.add_argument('--agent-timeout', default=None, type=float,
+                        help='Time given to the agent to send its command in seconds (default: the timeout value)')
 
     # simulation setup
     parser.add_argument('--routes',
@@ -441,6 +452,8 @@ def main():
     # agent-related options
     parser.add_argument("-a", "--agent", type=str, help="Path to Agent's py file to evaluate", required=True)
     parser.add_argument("--agent-config", type=str, help="Path to Agent's configuration file", default="")
+    parser.add_argument("--threaded-agent", action="store_true",
+                        help="Run the agent in a separate thread, at the same time as the scenario")
 
     parser.add_argument("--track", type=str, default='SENSORS', help="Participation track: SENSORS, MAP")
     parser.add_argument('--resume', type=bool, default=False, help='Resume execution from last checkpoint?')
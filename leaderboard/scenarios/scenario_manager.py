@@ -11,21 +11,29 @@ It must not be modified and is for reference only!
 """
 
 from __future__ import print_function
+from concurrent.futures import Future
 import signal
 import sys
+import threading
 import time
 
 import py_trees
 import carla
+from carla import command
 
 from srunner.scenariomanager.carla_data_provider import CarlaDataProvider
 from srunner.scenariomanager.timer import GameTime
-from srunner.scenariomanager.watchdog import Watchdog
 
 from autoagents.agent_wrapper import AgentWrapper, AgentError
 from envs.sensor_interface import SensorReceivedNoData
 from utils.result_writer import ResultOutputProvider
 
+GLOBAL_RESULT_SUCCESS = '\033[92m'+'SUCCESS'+'\033[0m'
+GLOBAL_RESULT_FAILURE = '\033[91m'+'FAILURE'+'\033[0m'
+
+SIMULATION_TIMEOUT_MESSAGE = "The simulation took longer than {}s to update"
+AGENT_TIMEOUT_MESSAGE = "Agent took longer than {}s to send its command"
+
 
 class ScenarioManager(object):
 
@@ -44,43 +52,83 @@ class ScenarioManager(object):
     4. If needed, cleanup with manager.stop_scenario()
     """
 
+    # Tunable parameters
+    debug_tree_period = 20  # in ticks
+    watchdog_tolerance = 1.0  # in seconds
 
-    def __init__(self, timeout, debug_mode=False):
+    def __init__(self, timeout, debug_mode=False, spectator_every=5, threaded_agent=False,
+                 tick_timeout=None, agent_timeout=None):
         """
         Setups up the parameters, which will be filled at load_scenario()
+
+        'timeout' is the time given to the simulation to update. The world ticks and the agent
+        can be given different times with 'tick_timeout' and 'agent_timeout', which default to it.
+
+        The spectator follows the ego vehicle once every 'spectator_every' ticks
+        (every tick in debug mode). Set it to None to never move the spectator.
+
+        If 'threaded_agent' is True, the agent is run in a separate daemon thread, while the main one
+        ticks the scenario. Only useful for agents that release the GIL (e.g. GPU inference),
+        and their code has to be safe to run outside the main thread. An agent that never returns
+        is left behind in its thread once the route fails, see is_agent_running().
         """
         self.scenario = None
         self.scenario_tree = None
         self.scenario_class = None
+        self._criteria = None
         self.ego_vehicles = None
         self.other_actors = None
 
         self._debug_mode = debug_mode
         self._agent = None
+        self._world = None
+        self._client = None
+        self._ego_id = None
+        self._tree_tick = None
         self._running = False
         self._timestamp_last_run = 0.0
-        self._timeout = float(timeout)
+        self._sync_mode = True
+        self._world_watchdog_timeout = float(timeout)
+        self._tick_timeout = float(tick_timeout) if tick_timeout is not None else self._world_watchdog_timeout
+        self._agent_timeout = float(agent_timeout) if agent_timeout is not None else self._world_watchdog_timeout
+        self._spectator_every = spectator_every
+        self._spectator_offset = carla.Location(z=50)
+        self._spectator_rotation = carla.Rotation(pitch=-90)
+        self._tick_count = 0
+        self._last_tree_status = None
+        self._threaded_agent = threaded_agent
+        self._agent_thread = None
 
         self.scenario_duration_system = 0.0
         self.scenario_duration_game = 0.0
         self.start_system_time = None
         self.end_system_time = None
         self.end_game_time = None
+        self._start_monotonic_time = None
 
-        self._watchdog = None
-        self._agent_watchdog = None
+        self._watchdog_started = False
+        self._watchdog_failed = False
+        self._deadline = (SIMULATION_TIMEOUT_MESSAGE, self._world_watchdog_timeout)
 
-        # Use the callback_id inside the signal handler to allow external interrupts
+        # Use the callback_id inside the signal handler to allow external interrupts.
+        # SIGALRM is sent by the watchdog timer, see _set_deadline(). Note that this replaces
+        # any other SIGALRM handler, so neither the agents nor the scenarios can use signal.alarm()
+        # or the ITIMER_REAL timer, and that signal handlers can only be set from the main thread
         signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGALRM, self.signal_handler)
 
     def signal_handler(self, signum, frame):
         """
-        Terminate scenario ticking when receiving a signal interrupt
+        Terminate scenario ticking when receiving a signal interrupt,
+        or fail if the watchdog timer has expired. Only a simulation deadline marks
+        the simulation as failed, a late agent just stops its route
         """
-        if self._agent_watchdog and not self._agent_watchdog.get_status():
-            raise RuntimeError("Agent took longer than {}s to send its command".format(self._timeout))
-        elif self._watchdog and not self._watchdog.get_status():
-            raise RuntimeError("The simulation took longer than {}s to update".format(self._timeout))
+        if signum == signal.SIGALRM:
+            print('Watchdog exception - Deadline reached')
+            message, timeout = self._deadline
+            if message != AGENT_TIMEOUT_MESSAGE:
+                self._watchdog_failed = True
+            raise RuntimeError(message.format(timeout))
         self._running = False
 
     def cleanup(self):
@@ -88,15 +136,25 @@ class ScenarioManager(object):
         Reset all parameters
         """
         self._timestamp_last_run = 0.0
+        self._tick_count = 0
+        self._last_tree_status = None
         self.scenario_duration_system = 0.0
         self.scenario_duration_game = 0.0
         self.start_system_time = None
         self.end_system_time = None
         self.end_game_time = None
+        self._start_monotonic_time = None
 
+        self._world = None
+        self._client = None
+        self._ego_id = None
+        self._tree_tick = None
+        self._criteria = None
         self._spectator = None
-        self._watchdog = None
-        self._agent_watchdog = None
+        self._agent_thread = None
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        self._watchdog_started = False
+        self._watchdog_failed = False
 
     def load_scenario(self, scenario, agent, rep_number):
         """
@@ -108,11 +166,17 @@ class ScenarioManager(object):
         self.scenario_class = scenario
         self.scenario = scenario.scenario
         self.scenario_tree = self.scenario.scenario_tree
+        self._tree_tick = self.scenario_tree.tick_once
+        self._criteria = self.scenario.get_criteria()
         self.ego_vehicles = scenario.ego_vehicles
         self.other_actors = scenario.other_actors
         self.repetition_number = rep_number
 
-        self._spectator = CarlaDataProvider.get_world().get_spectator()
+        self._world = CarlaDataProvider.get_world()
+        self._client = CarlaDataProvider.get_client()
+        self._ego_id = self.ego_vehicles[0].id
+        self._spectator = self._world.get_spectator()
+        self._sync_mode = CarlaDataProvider.is_sync_mode()
 
         # To print the scenario tree uncomment the next line
         # py_trees.display.render_dot_tree(self.scenario_tree)
@@ -123,108 +187,189 @@ class ScenarioManager(object):
         """
         Trigger the start of the scenario and wait for it to finish/fail
         """
+        self._start_scenario()
+
+        snapshot = None
+        while self._running and self.get_running_status():
+            snapshot = self._wait_for_frame(snapshot)
+            if snapshot:
+                self._tick_scenario(snapshot)
+
+    def _start_scenario(self):
+        """
+        Start the timers and the watchdog of the scenario
+        """
         self.start_system_time = time.time()
+        self._start_monotonic_time = time.monotonic()
         self.start_game_time = GameTime.get_time()
 
-        # Detects if the simulation is down
-        self._watchdog = Watchdog(self._timeout)
-        self._watchdog.start()
-
-        # Stop the agent from freezing the simulation
-        self._agent_watchdog = Watchdog(self._timeout)
-        self._agent_watchdog.start()
+        # Detects if either the simulation is down or the agent is freezing it
+        self._watchdog_started = True
+        self._watchdog_failed = False
+        self._set_deadline(self._world_watchdog_timeout, SIMULATION_TIMEOUT_MESSAGE)
 
         self._running = True
 
-        while self._running:
-            timestamp = None
-            world = CarlaDataProvider.get_world()
-            if world:
-                snapshot = world.get_snapshot()
-                if snapshot:
-                    timestamp = snapshot.timestamp
-            if timestamp:
-                self._tick_scenario(timestamp)
-
-    def _tick_scenario(self, timestamp):
+    def _wait_for_frame(self, snapshot):
+        """
+        Wait for the frame that follows the given snapshot (None at the start of the scenario),
+        returning its snapshot, or None if no new frame is available yet
+        """
+        if self._sync_mode:
+            # The world is only ticked by this client, so every tick is a new frame
+            if snapshot:
+                self._set_deadline(self._tick_timeout, SIMULATION_TIMEOUT_MESSAGE)
+                self._world.tick(self._tick_timeout)
+            return self._world.get_snapshot()
+
+        # Sleep until the server notifies a new frame. Use a short timeout
+        # so that interruptions (self._running = False) are noticed quickly
+        try:
+            snapshot = self._world.wait_for_tick(self._world_watchdog_timeout / 10)
+        except RuntimeError:
+            if not self.get_running_status():
+                raise
+            return None
+
+        if self._timestamp_last_run >= snapshot.timestamp.elapsed_seconds:
+            return None
+
+        self._timestamp_last_run = snapshot.timestamp.elapsed_seconds
+        return snapshot
+
+    def _tick_scenario(self, snapshot):
         """
-        Run next tick of scenario and the agent and tick the world.
+        Run next tick of scenario and the agent, given the world snapshot of the current frame
         """
+        ego_id = self._ego_id
 
-        if self._timestamp_last_run < timestamp.elapsed_seconds and self._running:
-            self._timestamp_last_run = timestamp.elapsed_seconds
+        self._set_deadline(self._world_watchdog_timeout, SIMULATION_TIMEOUT_MESSAGE)
+        # Update game time and actor information
+        GameTime.on_carla_tick(snapshot.timestamp)
+        CarlaDataProvider.on_carla_tick()
 
-            self._watchdog.update()
-            # Update game time and actor information
-            GameTime.on_carla_tick(timestamp)
-            CarlaDataProvider.on_carla_tick()
-            self._watchdog.pause()
+        agent_future = None
+        if self._threaded_agent:
+            # The scenario doesn't depend on the agent's action, which is only
+            # applied before the world tick, so run both at the same time
+            agent_future = self._run_agent_in_thread()
+            self._tick_scenario_tree()
 
-            try:
-                self._agent_watchdog.resume()
-                self._agent_watchdog.update()
-                ego_action = self._agent()
-                self._agent_watchdog.pause()
+        self._set_deadline(self._agent_timeout, AGENT_TIMEOUT_MESSAGE)
+        try:
+            ego_action = agent_future.result() if agent_future else self._agent()
+
+        # Special exception inside the agent that isn't caused by the agent
+        except SensorReceivedNoData as e:
+            raise RuntimeError(e)
 
-            # Special exception inside the agent that isn't caused by the agent
-            except SensorReceivedNoData as e:
-                raise RuntimeError(e)
+        except Exception as e:
+            raise AgentError(e)
 
-            except Exception as e:
-                raise AgentError(e)
+        self._set_deadline(self._world_watchdog_timeout, SIMULATION_TIMEOUT_MESSAGE)
 
-            self._watchdog.resume()
-            self.ego_vehicles[0].apply_control(ego_action)
+        # Send the ego control and the spectator update as a single asynchronous batch. The ego's
+        # transform comes from the snapshot, so it matches the frame that has been processed
+        batch = [command.ApplyVehicleControl(ego_id, ego_action)]
 
-            # Tick scenario
-            self.scenario_tree.tick_once()
+        self._tick_count += 1
+        if self._debug_mode or \
+                (self._spectator_every and self._tick_count % self._spectator_every == 0):
+            ego_trans = snapshot.find(ego_id).get_transform()
+            spectator_trans = carla.Transform(ego_trans.location + self._spectator_offset, self._spectator_rotation)
+            batch.append(command.ApplyTransform(self._spectator.id, spectator_trans))
 
-            if self._debug_mode:
-                print("\n")
-                py_trees.display.print_ascii_tree(
-                    self.scenario_tree, show_status=True)
-                sys.stdout.flush()
+        self._client.apply_batch(batch)
 
-            if self.scenario_tree.status != py_trees.common.Status.RUNNING:
-                self._running = False
+        if not agent_future:
+            self._tick_scenario_tree()
 
-            ego_trans = self.ego_vehicles[0].get_transform()
-            self._spectator.set_transform(carla.Transform(ego_trans.location + carla.Location(z=50),
-                                                          carla.Rotation(pitch=-90)))
+    def _run_agent_in_thread(self):
+        """
+        Run the agent in a new daemon thread, returning a future with its action.
+        Being a daemon, a thread stuck in the agent doesn't prevent the process from exiting
+        """
+        if self.is_agent_running():
+            raise RuntimeError("The previous call to the agent hasn't finished")
 
-        if self._running and self.get_running_status():
-            CarlaDataProvider.get_world().tick(self._timeout)
+        agent = self._agent
+        agent_future = Future()
+
+        def run_agent():
+            try:
+                agent_future.set_result(agent())
+            except Exception as e:  # pylint: disable=broad-except
+                agent_future.set_exception(e)
+
+        self._agent_thread = threading.Thread(target=run_agent)
+        self._agent_thread.daemon = True
+        self._agent_thread.start()
+
+        return agent_future
+
+    def is_agent_running(self):
+        """
+        returns:
+           bool: True if the agent is still computing an action in its thread, False otherwise
+        """
+        return self._agent_thread is not None and self._agent_thread.is_alive()
+
+    def _tick_scenario_tree(self):
+        """
+        Tick the scenario tree, stopping the scenario once it has finished
+        """
+        self._tree_tick()
+        status = self.scenario_tree.status
+
+        # Only print the tree when its status changes, or once in a while
+        if self._debug_mode and (status != self._last_tree_status
+                                 or self._tick_count % self.debug_tree_period == 0):
+            sys.stdout.write("\n\n")
+            py_trees.display.print_ascii_tree(
+                self.scenario_tree, show_status=True)
+            sys.stdout.flush()
+            self._last_tree_status = status
+
+        if status != py_trees.common.Status.RUNNING:
+            self._running = False
+
+    def _set_deadline(self, timeout, message):
+        """
+        (Re)arm the watchdog, a real time interval timer that sends a SIGALRM to the process
+        if it isn't rearmed or stopped before 'timeout' seconds (plus some tolerance).
+        The signal is always handled in the main thread, which has to be the one running the scenario.
+        'message' is the error raised if the timer expires, formatted with the timeout
+        """
+        self._deadline = (message, timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout + self.watchdog_tolerance)
 
     def get_running_status(self):
         """
         returns:
            bool: False if watchdog exception occured, True otherwise
         """
-        if self._watchdog:
-            return self._watchdog.get_status()
-        return False
+        return self._watchdog_started and not self._watchdog_failed
 
     def stop_scenario(self):
         """
         This function triggers a proper termination of a scenario
         """
-        if self._watchdog:
-            self._watchdog.stop()
-
-        if self._agent_watchdog:
-            self._agent_watchdog.stop()
+        # Disarm the watchdog timer
+        signal.setitimer(signal.ITIMER_REAL, 0)
 
         self.end_system_time = time.time()
         self.end_game_time = GameTime.get_time()
 
-        self.scenario_duration_system = self.end_system_time - self.start_system_time
+        # The system times are only used for reporting, measure the duration with a monotonic clock
+        self.scenario_duration_system = time.monotonic() - self._start_monotonic_time
         self.scenario_duration_game = self.end_game_time - self.start_game_time
 
         if self.get_running_status():
             if self.scenario is not None:
                 self.scenario.terminate()
 
-            if self._agent is not None:
+            # Don't clean up an agent that is still computing an action in its thread
+            if self._agent is not None and not self.is_agent_running():
                 self._agent.cleanup()
                 self._agent = None
 
@@ -234,13 +379,14 @@ class ScenarioManager(object):
         """
         Analyzes and prints the results of the route
         """
-        global_result = '\033[92m'+'SUCCESS'+'\033[0m'
-
-        for criterion in self.scenario.get_criteria():
-            if criterion.test_status != "SUCCESS":
-                global_result = '\033[91m'+'FAILURE'+'\033[0m'
-
+        # A timeout invalidates the whole route, no need to check the criteria
         if self.scenario.timeout_node.timeout:
-            global_result = '\033[91m'+'FAILURE'+'\033[0m'
+            global_result = GLOBAL_RESULT_FAILURE
+        else:
+            global_result = GLOBAL_RESULT_SUCCESS
+            for criterion in self._criteria:
+                if criterion.test_status != "SUCCESS":
+                    global_result = GLOBAL_RESULT_FAILURE
+                    break
 
         ResultOutputProvider(self, global_result)